@@ -1,8 +1,6 @@
 from __future__ import annotations
 
 import os
-import threading
-import time
 from typing import Callable
 
 import aqt
@@ -12,28 +10,53 @@ from aqt.operations import QueryOp
 from aqt.utils import openLink, qconnect
 
 from .anki_api import AnkiApi as Anki
-from .limit import update_limits
-from .report import rule_mapping_report, text_dialog, utilization_dialog
+from .schedule import LimitScheduler
+
+# modules for calculating limits and showing reports are imported when first used to keep profile load fast
 
 
 def exec_in_background(func: Callable) -> Callable:
     return lambda: QueryOp(parent=aqt.mw, op=lambda col: func(), success=lambda *a, **k: None).run_in_background() # type: ignore[arg-type]
 
-def update_limits_on_interval_loop(anki: Anki) -> None:
-    while not anki.is_ready():
-        time.sleep(60) # wait for config to be accessible
-    while True:
-        addon_config = anki.get_config()
-        sleep_interval = max(60, addon_config['updateLimitsIntervalTimeInMinutes'] * 60)
-        time.sleep(sleep_interval)
+def update_limits(anki: Anki, hook_enabled_config_key: str | None = None, force_update: bool = False) -> None:
+    from .limit import update_limits
+    update_limits(anki, hook_enabled_config_key=hook_enabled_config_key, force_update=force_update)
+
+def show_rule_mapping_report(anki: Anki) -> None:
+    from .report import rule_mapping_report, text_dialog
+    text_dialog(rule_mapping_report(anki), 'Rule Mapping Report')
+
+def show_history_report(anki: Anki) -> None:
+    from .report import history_report, text_dialog
+    text_dialog(history_report(anki), 'Limit History Report')
+
+def show_utilization_report(anki: Anki) -> None:
+    from .report import utilization_dialog
+    utilization_dialog(anki)
+
+def export_rule_mapping(anki: Anki, path: str) -> int:
+    from .export import export_rule_mapping
+    return export_rule_mapping(anki, path)
+
+def export_utilization(anki: Anki, path: str) -> int:
+    from .export import export_utilization
+    return export_utilization(anki, path)
 
-        update_limits(anki, hook_enabled_config_key='updateLimitsOnInterval')
+def export_in_background(anki: Anki, title: str, file_name: str, export: Callable[[Anki, str], int]) -> None:
+    from .report import export_file_dialog
+    path = export_file_dialog(title, file_name)
+    if path:
+        exec_in_background(lambda: anki.tooltip(f'Exported {export(anki, path)} rows to {path}'))()
 
 def init() -> None:
     anki = Anki(__name__)
 
-    update_limits_on_interval_thread = threading.Thread(target=lambda: update_limits_on_interval_loop(anki), daemon=True)
-    update_limits_on_interval_thread.start()
+    scheduler = LimitScheduler(anki, lambda: update_limits(anki, hook_enabled_config_key='updateLimitsOnInterval'))
+    gui_hooks.profile_did_open.append(scheduler.on_profile_did_open)
+    gui_hooks.profile_will_close.append(scheduler.on_profile_will_close)
+    gui_hooks.reviewer_did_answer_card.append(lambda *args: scheduler.on_review())
+    aqt.mw.addonManager.setConfigUpdatedAction(__name__, lambda config: scheduler.start_if_enabled()) # type: ignore[union-attr]
+    scheduler.start_if_enabled()
 
     gui_hooks.main_window_did_init.append(exec_in_background(lambda: update_limits(anki, hook_enabled_config_key='updateLimitsOnApplicationStartup')))
     gui_hooks.sync_did_finish.append(lambda: update_limits(anki, hook_enabled_config_key='updateLimitsAfterSync'))
@@ -46,13 +69,29 @@ def init() -> None:
     menu.addAction(recalculate)
 
     rule_mapping_report_action = qt.QAction("Show rule mapping report", menu)
-    qconnect(rule_mapping_report_action.triggered, lambda: text_dialog(rule_mapping_report(anki), 'Rule Mapping Report'))
+    qconnect(rule_mapping_report_action.triggered, lambda: show_rule_mapping_report(anki))
     menu.addAction(rule_mapping_report_action)
 
     limit_utilization_report_action = qt.QAction("Show limit utilization report", menu)
-    qconnect(limit_utilization_report_action.triggered, lambda: utilization_dialog(anki))
+    qconnect(limit_utilization_report_action.triggered, lambda: show_utilization_report(anki))
     menu.addAction(limit_utilization_report_action)
 
+    history_report_action = qt.QAction("Show limit history report", menu)
+    qconnect(history_report_action.triggered, lambda: show_history_report(anki))
+    menu.addAction(history_report_action)
+
+    menu.addSeparator()
+
+    export_rule_mapping_action = qt.QAction("Export rule mapping data...", menu)
+    qconnect(export_rule_mapping_action.triggered, lambda: export_in_background(anki, 'Export Rule Mapping Data', 'rule-mapping.csv', export_rule_mapping))
+    menu.addAction(export_rule_mapping_action)
+
+    export_utilization_action = qt.QAction("Export limit utilization data...", menu)
+    qconnect(export_utilization_action.triggered, lambda: export_in_background(anki, 'Export Limit Utilization Data', 'limit-utilization.csv', export_utilization))
+    menu.addAction(export_utilization_action)
+
+    menu.addSeparator()
+
     documentation_action = qt.QAction("Documentation", menu)
     qconnect(documentation_action.triggered, lambda: openLink('https://github.com/lune-stone/anki-addon-limit-new-by-young'))
     menu.addAction(documentation_action)
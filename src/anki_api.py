@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import os
 from typing import TYPE_CHECKING, Any, Callable, NewType
 
 try:
@@ -9,7 +10,6 @@ except:
     Self = NewType('Self', Any) # type: ignore[misc, valid-newtype, no-redef]
 
 import aqt
-from anki.utils import ids2str
 from aqt.utils import tooltip
 
 if TYPE_CHECKING:
@@ -34,11 +34,15 @@ class AnkiApi:
     def write_config(self: Self, config: dict[str, Any]) -> None:
         self._mw().addonManager.writeConfig(self._module_name, config)
 
+    def history_path(self: Self) -> str:
+        # kept with the profile since deck ids and scheduler days are only meaningful for the profile's collection
+        return os.path.join(self._mw().pm.profileFolder(), 'limit-new-by-young-history.db')
+
     def get_deck_identifiers(self: Self) -> Sequence[DeckNameId]:
         return self._mw().col.decks.all_names_and_ids(include_filtered=False)
 
-    def get_subdeck_ids_csv(self: Self, deck_id: DeckId) -> str:
-        return ids2str(self._mw().col.decks.deck_and_child_ids(deck_id))
+    def get_subdeck_ids(self: Self, deck_id: DeckId) -> Sequence[DeckId]:
+        return self._mw().col.decks.deck_and_child_ids(deck_id)
 
     def get_deck_by_id(self: Self, deck_id: DeckId) -> DeckDict:
         return self._mw().col.decks.get(deck_id) or dict()
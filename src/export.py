@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import csv
+import json
+import math
+from typing import TYPE_CHECKING
+
+from . import report
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Sequence
+
+    from .anki_api import AnkiApi as Anki
+
+
+def _cell(value: object) -> object:
+    # `inf` is used for decks without a defined limit, which is not valid json
+    return None if isinstance(value, float) and math.isinf(value) else value
+
+def write_rows(rows: Iterable[object], columns: Sequence[str], path: str) -> int:
+    '''writes each row as it is produced to path as json lines if it ends with `.jsonl` otherwise as csv, returns the number of rows written'''
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.jsonl'):
+            for row in rows:
+                f.write(json.dumps({x: _cell(getattr(row, x)) for x in columns}) + '\n')
+                count += 1
+        else:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([_cell(getattr(row, x)) for x in columns])
+                count += 1
+    return count
+
+def export_utilization(anki: Anki, path: str) -> int:
+    '''writes the limit utilization report data to path, returns the number of rows written'''
+    return write_rows(report.iter_utilization_rows(anki), report.UTILIZATION_COLUMNS, path)
+
+def export_rule_mapping(anki: Anki, path: str) -> int:
+    '''writes the rule mapping report data to path, returns the number of rows written'''
+    return write_rows(report.iter_rule_mapping_rows(anki), report.RULE_MAPPING_COLUMNS, path)
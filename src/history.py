@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from dataclasses import dataclass
+
+# samples older than this many days are reduced to the last sample of each day for each deck
+FULL_RESOLUTION_DAYS = 7
+# oldest samples are dropped once the history has more rows than this
+MAX_ROWS = 100_000
+
+
+@dataclass
+class Sample:
+    time: int # seconds since epoch
+    day: int # scheduler day the sample was taken on
+    deck_id: int
+    metrics: dict[str, float] # value of each metric by limit key, only for the metrics that were needed to calculate the limit
+    collective: bool # metrics are the totals for the rule rather than the deck when `True`
+    new_limit: int
+
+def _connect(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS samples (
+            time INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            deck_id INTEGER NOT NULL,
+            metrics TEXT NOT NULL,
+            collective INTEGER NOT NULL,
+            new_limit INTEGER NOT NULL
+        )''')
+    con.execute('CREATE INDEX IF NOT EXISTS samples_deck_day ON samples (deck_id, day)')
+    return con
+
+def compact(con: sqlite3.Connection, today: int, max_rows: int = MAX_ROWS) -> None:
+    '''downsamples old entries, at most once per day, then enforces the size cap'''
+    # `user_version` holds the day the history was last downsampled
+    if con.execute('PRAGMA user_version').fetchone()[0] != today:
+        con.execute('''
+            DELETE FROM samples
+            WHERE day < ?
+            AND rowid NOT IN (SELECT max(rowid) FROM samples WHERE day < ? GROUP BY deck_id, day)
+            ''', (today - FULL_RESOLUTION_DAYS, today - FULL_RESOLUTION_DAYS))
+        con.execute(f'PRAGMA user_version = {int(today)}')
+
+    con.execute('DELETE FROM samples WHERE rowid <= (SELECT max(rowid) FROM samples) - ?', (max_rows,))
+
+def append(path: str, today: int, samples: list[Sample], max_rows: int = MAX_ROWS) -> None:
+    '''stores the samples that differ from the last one stored for their deck'''
+    if not samples:
+        return
+    con = _connect(path)
+    try:
+        with con:
+            last = {did: tuple(rest) for (did, *rest) in con.execute('''
+                SELECT deck_id, metrics, collective, new_limit
+                FROM samples
+                WHERE rowid IN (SELECT max(rowid) FROM samples GROUP BY deck_id)
+                ''')}
+            rows = [(x.time, x.day, x.deck_id, json.dumps(x.metrics, sort_keys=True), int(x.collective), x.new_limit) for x in samples]
+            # limits are updated many times a day, mostly without any change, which would otherwise push out older entries
+            con.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)', [x for x in rows if last.get(x[2]) != x[3:]])
+            compact(con, today, max_rows)
+    finally:
+        con.close()
+
+def read(path: str, since_day: int = 0, deck_id: int | None = None) -> list[Sample]:
+    '''returns the samples for every deck, or only `deck_id` if given, in the order they were taken'''
+    con = _connect(path)
+    try:
+        if deck_id is None:
+            rows = con.execute('SELECT * FROM samples WHERE day >= ? ORDER BY rowid', (since_day,)).fetchall()
+        else:
+            rows = con.execute('SELECT * FROM samples WHERE deck_id = ? AND day >= ? ORDER BY rowid', (deck_id, since_day)).fetchall()
+    finally:
+        con.close()
+    return [Sample(time, day, did, json.loads(metrics), bool(collective), new_limit) for (time, day, did, metrics, collective, new_limit) in rows]
@@ -1,14 +1,29 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import json
 import math
 import re
-from typing import TYPE_CHECKING
+import sqlite3
+import time
+import traceback
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable
 
 if TYPE_CHECKING:
-    from anki.decks import DeckId
+    from anki.decks import DeckId, DeckNameId
 
     from .anki_api import AnkiApi as Anki
 
+from . import history, metrics
+
+# limits that are not defined in the config are treated as this value
+NO_LIMIT = 999999999
+
+# fingerprint of each rule group's inputs as of the last time it was evaluated, keyed by rule index
+_group_fingerprints: dict[int, str] = {}
+
 
 def rule_mapping(anki: Anki) -> dict[DeckId, list[int]]:
     """returns the indices for matching rules where the first index is the one that determines the limits for the deck"""
@@ -24,38 +39,82 @@ def rule_mapping(anki: Anki) -> dict[DeckId, list[int]]:
 
     return ret
 
-# copy the dailyLoad calculation from https://github.com/open-spaced-repetition/fsrs4anki-helper/blob/19581d42a957285a8d949aea0564f81296a62b81/stats.py#L25
-def daily_load(anki: Anki, did: DeckId) -> float:
-    '''Takes in a number deck id, returns the estimated load in reviews per day'''
-    return (anki.db().first(
-        f"""
-    SELECT SUM(1.0 / max(1, ivl))
-    FROM cards
-    WHERE queue != -1 -- not suspended
-    AND did IN {anki.get_subdeck_ids_csv(did)}
-    AND type != 0 -- not new
-    """
-    ) or [0])[0] or 0
-
-def young(anki: Anki, deck_id: DeckId) -> int:
-    '''returns the number of young cards excluding suspended'''
-    did = re.sub('[()]', '', anki.get_subdeck_ids_csv(deck_id))
-    return len(list(anki.col().find_cards(f'-is:new prop:ivl<21 -is:suspended did:{did}')))
-
-def soon(anki: Anki, deck_id: DeckId, days: int) -> int:
-    '''returns the number of cards about to be due excluding suspended'''
-    did = re.sub('[()]', '', anki.get_subdeck_ids_csv(deck_id))
-    return len(list(anki.col().find_cards(f'prop:due<{days} -is:suspended did:{did}')))
-
-def cards(anki: Anki, deck_id: DeckId) -> int:
-    '''returns the number of cards in the deck or it's subdecks'''
-    did = re.sub('[()]', '', anki.get_subdeck_ids_csv(deck_id))
-    return len(list(anki.col().find_cards(f'-is:suspended did:{did}')))
-
-def seen(anki: Anki, deck_id: DeckId) -> int:
-    '''returns the number of seen cards in the deck or it's subdecks'''
-    did = re.sub('[()]', '', anki.get_subdeck_ids_csv(deck_id))
-    return len(list(anki.col().find_cards(f'(is:learn OR is:review) -is:suspended did:{did}')))
+def cards_stamp(anki: Anki) -> list[Any]:
+    '''returns a value that changes whenever any card is reviewed, edited, moved, added, or removed on this device'''
+    return list(anki.db().first('SELECT max(mod), count() FROM cards') or [])
+
+def group_fingerprint(anki: Anki, rule: dict[str, Any], group_decks: list[DeckNameId], today: int, stamp: list[Any]) -> str:
+    '''returns a hash of every input that can affect the limits calculated for a rule group'''
+    inputs: list[Any] = [rule, today, stamp]
+    for deck_ident in sorted(group_decks, key=lambda d: d.id):
+        deck = anki.get_deck_by_id(deck_ident.id)
+        deck_config = anki.config_dict_for_deck_id(deck_ident.id)
+        inputs.append([
+            deck_ident.id,
+            deck_ident.name, # collective rules distribute the new cards in order of name
+            list(anki.get_subdeck_ids(deck_ident.id)),
+            deck.get('newLimit'),
+            deck_config['new']['perDay'],
+            deck['newToday'],
+            deck['newLimitToday'],
+        ])
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class PruneStats:
+    evaluated: int = 0
+    pruned: int = 0
+
+@dataclass
+class PendingDecks:
+    rule: dict[str, Any]
+    deck_ids: list[DeckId]
+    decks: list[dict[str, Any]]
+    outcome: Callable[[float], tuple[float, ...]]
+
+def limit_already_set(deck: dict[str, Any], today: int) -> bool:
+    return False if deck["newLimitToday"] is None else deck["newLimitToday"]["today"] == today
+
+def distribute(budget: float, decks: list[tuple[int, int]], minimum: int) -> tuple[float, ...]:
+    '''splits the budget between decks in order, where each deck is a tuple of (max new cards per day, new cards today)'''
+    ret = []
+    remaining = budget
+    for max_new_cards_per_day, new_today in decks:
+        new_limit = max(0, minimum - new_today, min(max_new_cards_per_day - new_today, remaining) + new_today)
+        ret.append(new_limit)
+
+        # same as `remaining -= min(consumed, remaining)` but also works for infinite bounds
+        consumed = max(0, new_limit - new_today)
+        remaining = remaining - consumed if consumed < remaining else 0
+    return tuple(ret)
+
+def budget(rule: dict[str, Any], values: dict[str, float]) -> float:
+    '''returns how many more new cards the rule's limits allow given the value of each limited metric'''
+    ret: float = NO_LIMIT
+    for metric in metrics.active_metrics(rule):
+        headroom = rule[metric.limit_key] - values[metric.limit_key]
+        ret = min(ret, math.ceil(headroom) if metric.round_up and math.isfinite(headroom) else headroom)
+    return ret
+
+def determined_outcome(pending: PendingDecks) -> tuple[float, ...] | None:
+    '''returns the outcome if it is the same for any value of the metrics, such as when the native limit is 0 or the minimum is reached'''
+    keys = [x.limit_key for x in metrics.active_metrics(pending.rule)]
+    lower = pending.outcome(budget(pending.rule, {x: math.inf for x in keys}))
+    upper = pending.outcome(budget(pending.rule, {x: 0.0 for x in keys}))
+    return upper if lower == upper else None
+
+def evaluate(pending: PendingDecks, data: dict[DeckId, dict[str, float]], context: dict[str, Any]) -> tuple[tuple[float, ...], dict[str, float]]:
+    '''returns the outcome for the decks along with the value of each limited metric'''
+    deck_size = sum(data[did]['cards'] for did in pending.deck_ids)
+    measured = {}
+    values = {}
+    for metric in metrics.active_metrics(pending.rule):
+        name, _ = metrics.column(metric, pending.rule, context)
+        measured[metric.limit_key] = sum(data[did][name] for did in pending.deck_ids)
+        # limits that can not be reached with the cards of the deck are treated as having no effect
+        values[metric.limit_key] = 0 if pending.rule[metric.limit_key] > deck_size * metric.max_per_card else measured[metric.limit_key]
+    return pending.outcome(budget(pending.rule, values)), measured
 
 
 def update_limits(anki: Anki, hook_enabled_config_key: str | None = None, force_update: bool = False) -> None:
@@ -63,6 +122,8 @@ def update_limits(anki: Anki, hook_enabled_config_key: str | None = None, force_
     today = anki.col().sched.today
 
     limits_changed = 0
+    stats = PruneStats()
+    samples: list[history.Sample] = []
 
     if hook_enabled_config_key and not addon_config.get(hook_enabled_config_key, False):
         return
@@ -82,104 +143,83 @@ def update_limits(anki: Anki, hook_enabled_config_key: str | None = None, force_
         primary_rule_idx = rule_indices[0]
         rule_groups.setdefault(primary_rule_idx, []).append(deck_ident)
 
+    # anything that changes the cards of a deck also changes this, so groups with an unchanged fingerprint can be skipped.
+    # cards pulled in by a sync keep their original `mod` so the collection's `mod`, which a sync does change, is included
+    stamp = [*cards_stamp(anki), anki.col().mod]
+    recalculate = force_update or addon_config.get('recalculateLimitIfAlreadySet', False)
+
+    def apply(pending: PendingDecks, new_limits: tuple[float, ...], measured: dict[str, float]) -> None:
+        nonlocal limits_changed
+        is_collective = pending.rule.get('collective', False)
+        for deck, new_limit in zip(pending.decks, new_limits, strict=True):
+            samples.append(history.Sample(int(time.time()), today, deck['id'], measured, is_collective, round(new_limit)))
+            if not(limit_already_set(deck, today) and deck["newLimitToday"]["limit"] == new_limit):
+                deck["newLimitToday"] = {"limit": round(new_limit), "today": today}
+                anki.save_deck(deck)
+                limits_changed += 1
+
+    evaluated_groups = []
+    pending_decks = []
     for rule_idx, group_decks in rule_groups.items():
         addon_config_limits = addon_config["limits"][rule_idx]
         is_collective = addon_config_limits.get('collective', False)
+        minimum = addon_config_limits.get('minimum', 0)
 
         # Check if any deck in the group needs updating
-        should_process = force_update or addon_config.get('recalculateLimitIfAlreadySet', False)
-        if not should_process:
-            for deck_ident in group_decks:
-                deck = anki.get_deck_by_id(deck_ident.id)
-                limit_already_set = False if deck["newLimitToday"] is None else deck["newLimitToday"]["today"] == today
-                if not limit_already_set:
-                    should_process = True
-                    break
-
-        if not should_process:
+        if not recalculate and all(limit_already_set(anki.get_deck_by_id(d.id), today) for d in group_decks):
             continue
 
-        if is_collective:
-            # --- Collective mode: sum metrics across all decks in the group ---
-            total_deck_size = sum(cards(anki, d.id) for d in group_decks)
-
-            young_card_limit = addon_config_limits.get('youngCardLimit', 999999999)
-            total_young = 0 if young_card_limit > total_deck_size else sum(young(anki, d.id) for d in group_decks)
-
-            load_limit = addon_config_limits.get('loadLimit', 999999999)
-            total_load = 0.0 if load_limit > total_deck_size else sum(daily_load(anki, d.id) for d in group_decks)
-
-            soon_days = addon_config_limits.get('soonDays', 7)
-            soon_limit = addon_config_limits.get('soonLimit', 999999999)
-            total_soon = 0 if soon_limit > total_deck_size else sum(soon(anki, d.id, soon_days) for d in group_decks)
-
-            minimum = addon_config_limits.get('minimum', 0)
-
-            # Collective budget: can be negative when over limit — per-deck formula handles clamping
-            collective_budget = min(
-                young_card_limit - total_young,
-                math.ceil(load_limit - total_load),
-                soon_limit - total_soon
-            )
+        fingerprint = group_fingerprint(anki, addon_config_limits, group_decks, today, stamp)
+        if not force_update and _group_fingerprints.get(rule_idx) == fingerprint:
+            continue
+        evaluated_groups.append((rule_idx, group_decks))
 
-            # Distribute budget across decks (sorted by name for determinism)
-            sorted_group = sorted(group_decks, key=lambda d: d.name)
+        if is_collective:
+            # Collective mode: metrics are summed across all decks in the group and the budget is shared (sorted by name for determinism)
+            deck_sets = [sorted(group_decks, key=lambda d: d.name)]
+        else:
+            # Per-deck mode: each deck evaluated independently
+            deck_sets = [[d] for d in group_decks if recalculate or not limit_already_set(anki.get_deck_by_id(d.id), today)]
 
-            remaining = collective_budget
-            for deck_ident in sorted_group:
-                deck = anki.get_deck_by_id(deck_ident.id)
+        for deck_set in deck_sets:
+            decks = [anki.get_deck_by_id(d.id) for d in deck_set]
+            new_card_caps = []
+            for deck_ident, deck in zip(deck_set, decks, strict=True):
                 deck_config = anki.config_dict_for_deck_id(deck_ident.id)
                 max_new_cards_per_day = deck.get('newLimit') or deck_config['new']['perDay']
                 new_today = 0 if today != deck['newToday'][0] else deck['newToday'][1]
-
-                effective_config_limit = remaining
-                new_limit = max(0, minimum - new_today, min(max_new_cards_per_day - new_today, effective_config_limit) + new_today)
-
-                consumed = max(0, new_limit - new_today)
-                remaining -= min(consumed, remaining)
-
-                limit_already_set = False if deck["newLimitToday"] is None else deck["newLimitToday"]["today"] == today
-                if not(limit_already_set and deck["newLimitToday"]["limit"] == new_limit):
-                    deck["newLimitToday"] = {"limit": round(new_limit), "today": today}
-                    anki.save_deck(deck)
-                    limits_changed += 1
-        else:
-            # --- Original per-deck mode: each deck evaluated independently ---
-            for deck_indentifer in group_decks:
-                deck = anki.get_deck_by_id(deck_indentifer.id)
-
-                limit_already_set = False if deck["newLimitToday"] is None else deck["newLimitToday"]["today"] == today
-
-                if not (force_update or addon_config.get('recalculateLimitIfAlreadySet', False)) and limit_already_set:
-                    continue
-
-                deck_config = anki.config_dict_for_deck_id(deck_indentifer.id)
-                deck_size = cards(anki, deck_indentifer.id)
-                new_today = 0 if today != deck['newToday'][0] else deck['newToday'][1]
-
-                young_card_limit = addon_config_limits.get('youngCardLimit', 999999999)
-                young_count = 0 if young_card_limit > deck_size else young(anki, deck_indentifer.id)
-
-                load_limit = addon_config_limits.get('loadLimit', 999999999)
-                load = 0.0 if load_limit > deck_size else daily_load(anki, deck_indentifer.id)
-
-                soon_days = addon_config_limits.get('soonDays', 7)
-                soon_limit = addon_config_limits.get('soonLimit', 999999999)
-                soon_count = 0 if soon_limit > deck_size else soon(anki, deck_indentifer.id, soon_days)
-
-                minimum = addon_config_limits.get('minimum', 0)
-
-                max_new_cards_per_day = deck.get('newLimit') or deck_config['new']['perDay']
-
-                effective_config_limit = min(young_card_limit - young_count, math.ceil(load_limit - load), soon_limit - soon_count)
-                new_limit = max(0, minimum - new_today, min(max_new_cards_per_day - new_today, effective_config_limit) + new_today)
-
-                if not(limit_already_set and deck["newLimitToday"]["limit"] == new_limit):
-                    deck["newLimitToday"] = {"limit": round(new_limit), "today": today}
-                    anki.save_deck(deck)
-                    limits_changed += 1
+                new_card_caps.append((max_new_cards_per_day, new_today))
+
+            pending = PendingDecks(addon_config_limits, [d.id for d in deck_set], decks, functools.partial(distribute, decks=new_card_caps, minimum=minimum))
+            metric_count = len(pending.deck_ids) * len(metrics.active_metrics(addon_config_limits))
+            new_limits = determined_outcome(pending)
+            if new_limits is not None:
+                stats.pruned += metric_count
+                apply(pending, new_limits, {})
+            else:
+                stats.evaluated += metric_count
+                pending_decks.append(pending)
+
+    # every metric needed by the remaining decks is calculated with a single query
+    context = metrics.query_context(anki)
+    columns = dict(metrics.column(metric, x.rule, context) for x in pending_decks for metric in metrics.active_metrics(x.rule))
+    data = metrics.query(anki, {did for x in pending_decks for did in x.deck_ids}, columns) if pending_decks else {}
+    for pending in pending_decks:
+        apply(pending, *evaluate(pending, data, context))
+
+    # saving a deck changes its `newLimitToday` and the collection's `mod` so the fingerprint is taken after the limits are applied
+    stamp[-1] = anki.col().mod
+    for rule_idx, group_decks in evaluated_groups:
+        _group_fingerprints[rule_idx] = group_fingerprint(anki, addon_config["limits"][rule_idx], group_decks, today, stamp)
 
     if limits_changed > 0:
         anki.safe_reset()
     if addon_config.get('showNotifications', False):
-        anki.tooltip(f'Updated {limits_changed} limits.')
+        anki.tooltip(f'Updated {limits_changed} limits ({stats.pruned} of {stats.evaluated + stats.pruned} deck metrics did not need to be calculated).')
+
+    if addon_config.get('recordHistory', False):
+        try:
+            history.append(anki.history_path(), today, samples)
+        except sqlite3.Error:
+            # the limits are already saved, so failing to record them, such as when another update holds the lock, is not fatal
+            traceback.print_exc()
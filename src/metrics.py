@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from anki.decks import DeckId
+
+    from .anki_api import AnkiApi as Anki
+
+
+@dataclass
+class Metric:
+    limit_key: str # config key of the limit, also used to identify the metric
+    title: str # heading used in the utilization report
+    expression: str # summed over each card that is not suspended, formatted with `params`, `today`, and `day_cutoff`
+    params: dict[str, Any] = field(default_factory=dict) # config keys used by `expression` and their default values
+    round_up: bool = False # round up the remaining headroom, so fractional values do not hold back the last card
+    max_per_card: float = 1 # most a single card can add, so limits above this times the deck size can not be reached
+
+# every metric is calculated with a single pass over the cards, so adding a metric does not add queries
+METRICS: dict[str, Metric] = {}
+
+# columns calculated along with every query
+BASE_COLUMNS = {
+    'cards': '1',
+    'seen': '(queue IN (1, 3) OR type IN (2, 3))', # is:learn OR is:review
+}
+
+def register(metric: Metric) -> None:
+    METRICS[metric.limit_key] = metric
+
+register(Metric('youngCardLimit', 'Young Limit', '(type != 0 AND ivl < 21)')) # -is:new prop:ivl<21
+# copy the dailyLoad calculation from https://github.com/open-spaced-repetition/fsrs4anki-helper/blob/19581d42a957285a8d949aea0564f81296a62b81/stats.py#L25
+register(Metric('loadLimit', 'Daily Load Limit', 'CASE WHEN type != 0 THEN 1.0 / max(1, ivl) ELSE 0 END', round_up=True))
+register(Metric('soonLimit', 'Soon Limit', # prop:due<{soonDays}, using the original due date for cards in filtered decks
+    '''(queue IN (2, 3) AND (CASE WHEN odue != 0 THEN odue ELSE due END) < {today} + {soonDays})
+    OR (queue IN (1, 4) AND ((CASE WHEN odue != 0 THEN odue ELSE due END) - {day_cutoff}) / 86400 < {soonDays})''',
+    params={'soonDays': 7}))
+# daily load where each card is weighted by its FSRS difficulty (1 to 10), cards without a difficulty count as average
+register(Metric('difficultyLoadLimit', 'Difficulty Weighted Load Limit',
+    '''CASE WHEN type != 0 THEN 1.0 / max(1, ivl)
+    * coalesce(CASE WHEN json_valid(data) THEN json_extract(data, '$.d') END, 5.5) / 5.5 ELSE 0 END''',
+    round_up=True, max_per_card=10 / 5.5))
+register(Metric('learningLimit', 'Learning Limit', 'queue IN (1, 3)')) # is:learn
+
+def active_metrics(rule: dict[str, Any]) -> list[Metric]:
+    '''returns the metrics that the rule defines a limit for'''
+    return [x for x in METRICS.values() if x.limit_key in rule]
+
+def query_context(anki: Anki) -> dict[str, Any]:
+    sched = anki.col().sched
+    return {'today': sched.today, 'day_cutoff': sched.day_cutoff}
+
+def column(metric: Metric, rule: dict[str, Any], context: dict[str, Any]) -> tuple[str, str]:
+    '''returns the name and sql of the column for the metric using the parameters of the rule'''
+    params = {k: rule.get(k, default) for (k, default) in metric.params.items()}
+    name = metric.limit_key + (f'({",".join(str(x) for x in params.values())})' if params else '')
+    return name, metric.expression.format(**context, **params)
+
+def query(anki: Anki, deck_ids: Iterable[DeckId], columns: dict[str, str]) -> dict[DeckId, dict[str, float]]:
+    '''returns the totals of `BASE_COLUMNS` and `columns` for each deck including it's sub decks, using a single pass over the cards'''
+    columns = {**BASE_COLUMNS, **columns}
+    subdeck_ids = {did: list(anki.get_subdeck_ids(did)) for did in deck_ids}
+    searched = ','.join(str(x) for x in sorted({x for ids in subdeck_ids.values() for x in ids}))
+    if not searched:
+        return {}
+
+    # like `did:` searches, cards in a filtered deck also count towards their home deck (`odid`)
+    select = ', '.join(f'SUM({sql}) AS "{name}"' for (name, sql) in columns.items())
+    rows = anki.db().all(f'''
+        SELECT did, odid, {select}
+        FROM cards
+        WHERE queue != -1 -- not suspended
+        AND (did IN ({searched}) OR odid IN ({searched}))
+        GROUP BY did, odid
+        ''')
+    rows_by_did: dict[int, set[int]] = {}
+    for idx, row in enumerate(rows):
+        for did in {row[0], row[1]} - {0}:
+            rows_by_did.setdefault(did, set()).add(idx)
+
+    ret = {}
+    for did, ids in subdeck_ids.items():
+        # a set so cards that match both by `did` and `odid` are only counted once
+        found = set().union(*(rows_by_did.get(x, set()) for x in ids))
+        ret[did] = {name: sum(rows[x][idx + 2] or 0 for x in found) for (idx, name) in enumerate(columns)}
+    return ret
@@ -2,18 +2,23 @@ from __future__ import annotations
 
 import dataclasses
 import math
+import os
 import re
 import sys
+import time
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Callable
+from typing import TYPE_CHECKING
 
 import aqt
 import aqt.qt as qt
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from .anki_api import AnkiApi as Anki
 
-from .limit import cards, daily_load, rule_mapping, seen, soon, young
+from . import history, metrics
+from .limit import rule_mapping
 
 
 def text_dialog(message: str, title: str) -> None:
@@ -39,6 +44,18 @@ def text_dialog(message: str, title: str) -> None:
 
     dialog.show()
 
+def export_file_dialog(title: str, file_name: str) -> str | None:
+    '''returns the path picked by the user to export to, or `None` if canceled'''
+    path, selected_filter = qt.QFileDialog.getSaveFileName(aqt.mw, title, file_name, 'CSV (*.csv);;JSON Lines (*.jsonl)')
+    if not path:
+        return None
+
+    # the format is picked by extension, which is not added to a typed name on every platform
+    extension = re.search(r'\(\*(\.[a-z]+)\)', selected_filter)
+    if extension and not os.path.splitext(path)[1]:
+        path += extension.group(1)
+    return path
+
 def utilization_dialog(anki: Anki) -> None:
     data = limit_utilization_report_data(anki)
     ui_config = anki.get_config().get('utilizationReport', {})
@@ -93,14 +110,15 @@ def utilization_dialog(anki: Anki) -> None:
         anki.write_config(config)
 
     def render() -> None:
-        d = [x for x in data]
-        d = [x for x in d if check_boxes['empty'].isChecked() or x.deck_size > 0]
-        d = [x for x in d if check_boxes['noLimit'].isChecked() or x.deck_has_limits]
-        d = [x for x in d if check_boxes['notStarted'].isChecked() or x.learned > 0]
-        d = [x for x in d if check_boxes['complete'].isChecked() or x.learned < x.deck_size]
-        d = [x for x in d if check_boxes['overLimit'].isChecked() or x.value < x.limit]
-        d = [x for x in d if check_boxes['underLimit'].isChecked() or x.value >= x.limit]
-        d = [x for x in d if check_boxes['subDeck'].isChecked() or '::' not in x.deck_name]
+        checked = {k: v.isChecked() for (k, v) in check_boxes.items()}
+        d = [x for x in data if
+            (checked['empty'] or x.deck_size > 0)
+            and (checked['noLimit'] or x.deck_has_limits)
+            and (checked['notStarted'] or x.learned > 0)
+            and (checked['complete'] or x.learned < x.deck_size)
+            and (checked['overLimit'] or x.value < x.limit)
+            and (checked['underLimit'] or x.value >= x.limit)
+            and (checked['subDeck'] or '::' not in x.deck_name)]
 
         lines = []
 
@@ -109,23 +127,14 @@ def utilization_dialog(anki: Anki) -> None:
             lines.append('')
             lines.extend([str(x) for x in d if x.detail_level == 'Summary'])
         else:
-            lines.append('=== Young Limit ===')
-            lines.append('')
-            lines.extend([str(x) for x in d if x.limit_type == 'youngCardLimit' and x.detail_level == 'Verbose'])
-
-            lines.append('')
-            lines.append('')
+            for idx, metric in enumerate(metrics.METRICS.values()):
+                if idx > 0:
+                    lines.append('')
+                    lines.append('')
 
-            lines.append('=== Daily Load Limit ===')
-            lines.append('')
-            lines.extend([str(x) for x in d if x.limit_type == 'loadLimit' and x.detail_level == 'Verbose'])
-
-            lines.append('')
-            lines.append('')
-
-            lines.append('=== Soon Limit ===')
-            lines.append('')
-            lines.extend([str(x) for x in d if x.limit_type == 'soonLimit' and x.detail_level == 'Verbose'])
+                lines.append(f'=== {metric.title} ===')
+                lines.append('')
+                lines.extend([str(x) for x in d if x.limit_type == metric.limit_key and x.detail_level == 'Verbose'])
 
         message = '\n'.join(lines)
         text_edit.setPlainText(message)
@@ -150,37 +159,95 @@ def utilization_dialog(anki: Anki) -> None:
 
 def rule_mapping_report(anki: Anki) -> str:
     limits = anki.get_config().get('limits', [])
-    deck_names = {x.id: x.name for x in anki.get_deck_identifiers()}
-    mapping = rule_mapping(anki)
+
+    by_rule: dict[int | None, list[RuleMappingRow]] = {}
+    for row in iter_rule_mapping_rows(anki):
+        by_rule.setdefault(row.rule, []).append(row)
 
     lines = []
     for idx, limit in enumerate(limits):
+        rows = by_rule.get(idx + 1, [])
         lines.append(f'rule #{idx + 1}: {str(limit)}')
 
-        applies = [k for (k,v) in mapping.items() if v[0:1] == [idx]]
-        matches = [k for (k,v) in mapping.items() if idx in v and k not in applies]
-
         lines.append('\tApplies to:')
-        for name in sorted([deck_names[x] for x in applies]):
-            lines.append(f'\t\t{name}')
+        lines.extend(f'\t\t{x.deck_name}' for x in rows if x.relation == 'applies')
 
+        matches = [x for x in rows if x.relation == 'matches']
         if matches:
             lines.append('\tMatches, but is already covered by an earlier rule:')
-            for name, rule in sorted([(deck_names[x], mapping[x][0] + 1) for x in matches]):
-                lines.append(f'\t\t{name} -> rule #{rule}')
+            lines.extend(f'\t\t{x.deck_name} -> rule #{x.applied_rule}' for x in matches)
 
         lines.append('')
 
     lines.append('not covered by any rules:')
-    for name in sorted([deck_names[k] for (k,v) in mapping.items() if not v]):
-        lines.append(f'\t{name}')
+    lines.extend(f'\t{x.deck_name}' for x in by_rule.get(None, []))
+
+    return '\n'.join(lines)
+
+def history_report(anki: Anki, days: int = 14) -> str:
+    '''shows the last recorded limit of each day for each deck, using only the stored history'''
+    today = anki.col().sched.today
+    deck_names = {x.id: x.name for x in anki.get_deck_identifiers()}
+
+    # later samples replace earlier ones so only the last sample of each day is kept
+    by_deck: dict[int, dict[int, history.Sample]] = {}
+    for sample in history.read(anki.history_path(), since_day=today - days):
+        by_deck.setdefault(sample.deck_id, {})[sample.day] = sample
+
+    lines = [f'=== Limit History (last {days} days) ===', '']
+    for did, name in sorted(deck_names.items(), key=lambda x: x[1]):
+        if did not in by_deck:
+            continue
+        lines.append(name)
+        previous = None
+        for _, sample in sorted(by_deck[did].items()):
+            change = '' if previous is None or previous == sample.new_limit else ' (up)' if sample.new_limit > previous else ' (down)'
+            # `young, load` rather than `youngCardLimit, loadLimit`
+            values = ', '.join(f'{re.sub("[A-Z][a-zA-Z]*", "", k)} {v:g}' for (k, v) in sample.metrics.items()) or 'no metrics needed'
+            scope = ' for the whole rule' if sample.collective else ''
+            lines.append(f'\t{time.strftime("%Y-%m-%d", time.localtime(sample.time))}: limit {sample.new_limit}{change}\t[{values}{scope}]')
+            previous = sample.new_limit
+        lines.append('')
+
+    if len(lines) == 2:
+        lines.append('No history has been recorded yet, check that `recordHistory` is enabled.')
 
     return '\n'.join(lines)
 
-@dataclass(order=True)
+@dataclass
+class RuleMappingRow:
+    rule: int | None # 1-based like the rule mapping report
+    relation: str # `applies`, `matches` (already covered by an earlier rule), or `none`
+    applied_rule: int | None
+    deck_id: int
+    deck_name: str
+
+RULE_MAPPING_COLUMNS = tuple(x.name for x in dataclasses.fields(RuleMappingRow))
+
+def iter_rule_mapping_rows(anki: Anki) -> Iterator[RuleMappingRow]:
+    '''yields which rules apply to or match each deck, in the order shown by `rule_mapping_report`'''
+    limits = anki.get_config().get('limits', [])
+    deck_names = {x.id: x.name for x in anki.get_deck_identifiers()}
+    mapping = rule_mapping(anki)
+    by_name = sorted(mapping.items(), key=lambda x: deck_names[x[0]])
+
+    for idx in range(len(limits)):
+        for did, rule_indices in by_name:
+            if rule_indices[0:1] == [idx]:
+                yield RuleMappingRow(idx + 1, 'applies', idx + 1, did, deck_names[did])
+        for did, rule_indices in by_name:
+            if idx in rule_indices[1:]:
+                yield RuleMappingRow(idx + 1, 'matches', rule_indices[0] + 1, did, deck_names[did])
+
+    for did, rule_indices in by_name:
+        if not rule_indices:
+            yield RuleMappingRow(None, 'none', None, did, deck_names[did])
+
+@dataclass
 class UtilizationRow:
-    display_ordinal: tuple
-    summary_ordinal: tuple
+    # there is a row per deck per limit type, so slots are used to keep large collections compact
+    __slots__ = ('utilization', 'value', 'limit', 'detail_level', 'limit_type', 'deck_id', 'deck_name', 'deck_size', 'learned', 'deck_has_limits')
+
     utilization: float
     value: int | float
     limit: int | float
@@ -193,6 +260,22 @@ class UtilizationRow:
     learned: int
     deck_has_limits: bool
 
+    @property
+    def display_ordinal(self: UtilizationRow) -> tuple:
+        return (-self.utilization, -self.value, self.limit, self.deck_name)
+
+    @property
+    def summary_ordinal(self: UtilizationRow) -> tuple:
+        return (-self.utilization, 0 if self.deck_has_limits else 1, -self.value, self.limit, self.deck_name) # prefer decks with defined limit should they all have 0 utilization
+
+    @property
+    def sort_key(self: UtilizationRow) -> tuple:
+        # built on each access, so sort with `key=` to build it once per row rather than twice per comparison
+        return (self.display_ordinal, self.detail_level, self.limit_type, self.deck_id)
+
+    def __lt__(self: UtilizationRow, other: UtilizationRow) -> bool:
+        return self.sort_key < other.sort_key
+
     def __str__(self: UtilizationRow) -> str:
         utilization = f'{min(9999.99, self.utilization):.2f}'
         value = f'{self.value:.2f}' if isinstance(self.value, float) else self.value
@@ -202,7 +285,10 @@ class UtilizationRow:
         limit_type = re.sub('[A-Z][a-zA-Z]*', '', limit_type) # `young, soon, load` rather than `youngCardLimit, ...`
         return f'{utilization}% ({value} of {limit}){limit_type}\t{self.deck_name}'
 
-def limit_utilization_report_data(anki: Anki) -> list[UtilizationRow]:
+UTILIZATION_COLUMNS = tuple(x.name for x in dataclasses.fields(UtilizationRow))
+
+def iter_utilization_rows(anki: Anki) -> Iterator[UtilizationRow]:
+    '''yields the verbose rows for each deck followed by the deck's summary row, in order of deck name'''
     limits = anki.get_config().get('limits', [])
     deck_names = {x.id: x.name for x in anki.get_deck_identifiers()}
     mapping = rule_mapping(anki)
@@ -213,58 +299,54 @@ def limit_utilization_report_data(anki: Anki) -> list[UtilizationRow]:
         if mapping[did]:
             rule_groups.setdefault(mapping[did][0], []).append(did)
 
+    # every metric for every deck is calculated with a single query
+    context = metrics.query_context(anki)
+    columns = dict(metrics.column(metric, rule, context) for rule in [{}, *limits] for metric in metrics.METRICS.values())
+    data = metrics.query(anki, deck_names, columns)
+
     # Pre-compute collective values only for rules with collective: true
     collective_values: dict[tuple[int, str], float] = {}
-    for rule_idx, group_dids in rule_groups.items():
-        rule = limits[rule_idx]
+    for group_rule_idx, group_dids in rule_groups.items():
+        rule = limits[group_rule_idx]
         if not rule.get('collective', False):
             continue
-        if 'youngCardLimit' in rule:
-            collective_values[(rule_idx, 'youngCardLimit')] = sum(young(anki, did) for did in group_dids)
-        if 'loadLimit' in rule:
-            collective_values[(rule_idx, 'loadLimit')] = sum(daily_load(anki, did) for did in group_dids)
-        if 'soonLimit' in rule:
-            collective_values[(rule_idx, 'soonLimit')] = sum(soon(anki, did, rule.get('soonDays', 7)) for did in group_dids)
-
-    def utilization_for_limit(limit_config_key: str, deck_indentifer_limit_func: Callable) -> list[UtilizationRow]:
+        for metric in metrics.active_metrics(rule):
+            name, _ = metrics.column(metric, rule, context)
+            collective_values[(group_rule_idx, metric.limit_key)] = sum(data[did][name] for did in group_dids)
+
+    for did, deck_name in sorted(deck_names.items(), key=lambda x: x[1]):
+        rule_idx = mapping[did][0] if mapping[did] else None
+        rule = {} if rule_idx is None else limits[rule_idx]
+        deck_size = int(data[did]['cards'])
+        learned = int(data[did]['seen'])
+
         rows = []
-        for did, deck_name in sorted(deck_names.items(), key=lambda x: x[1]):
-            rule_idx = mapping[did][0] if mapping[did] else None
-            rule = {} if rule_idx is None else limits[rule_idx]
-            limit = rule.get(limit_config_key, float('inf'))
+        for metric in metrics.METRICS.values():
+            limit = rule.get(metric.limit_key, float('inf'))
 
             # Use collective value only if rule is collective
-            if rule_idx is not None and (rule_idx, limit_config_key) in collective_values:
-                value = collective_values[(rule_idx, limit_config_key)]
+            if rule_idx is not None and (rule_idx, metric.limit_key) in collective_values:
+                value = collective_values[(rule_idx, metric.limit_key)]
             else:
-                deck_indentifer = {'id': did, 'name': deck_name}
-                value = deck_indentifer_limit_func(deck_indentifer, rule)
+                value = data[did][metrics.column(metric, rule, context)[0]]
 
             utilization = 100.0 * (value / max(limit, sys.float_info.epsilon))
-            deck_size = cards(anki, did)
-            learned = seen(anki, did)
             deck_has_limits = not math.isinf(limit)
-            report_ordinal = (-utilization, -value, limit, deck_name)
-            summary_ordinal = (-utilization, 0 if deck_has_limits else 1, -value, limit, deck_name) # prefer decks with defined limit should they all have 0 utilization
-
-            row = UtilizationRow(report_ordinal, summary_ordinal, utilization, value, limit, 'Verbose', limit_config_key, did, deck_name, deck_size, learned, deck_has_limits)
-            rows.append(row)
-        return rows
-
-    ret = []
-    ret.extend(utilization_for_limit('youngCardLimit', lambda deck_indentifer, rule: young(anki, deck_indentifer['id'])))
-    ret.extend(utilization_for_limit('loadLimit', lambda deck_indentifer, rule: daily_load(anki, deck_indentifer['id'])))
-    ret.extend(utilization_for_limit('soonLimit', lambda deck_indentifer, rule: soon(anki, deck_indentifer['id'], rule.get('soonDays', 7))))
-    ret.sort()
-
-    summary: dict[int, list[UtilizationRow]] = {}
-    for row in sorted(ret, key=lambda x: x.summary_ordinal):
-        deck_rows = summary.get(row.deck_id, [])
-        row = dataclasses.replace(row)
-        row.detail_level = 'Summary'
-        row.deck_has_limits = len([x for x in ret if x.deck_id == row.deck_id and x.deck_has_limits]) > 0
-        deck_rows.append(row)
-        summary[row.deck_id] = deck_rows
-    ret.extend(sorted([x[0] for x in summary.values()]))
+
+            rows.append(UtilizationRow(utilization, value, limit, 'Verbose', metric.limit_key, did, deck_name, deck_size, learned, deck_has_limits))
+        yield from rows
+
+        summary = dataclasses.replace(min(rows, key=lambda x: (x.summary_ordinal, x)))
+        summary.detail_level = 'Summary'
+        summary.deck_has_limits = any(x.deck_has_limits for x in rows)
+        yield summary
+
+def limit_utilization_report_data(anki: Anki) -> list[UtilizationRow]:
+    ret: list[UtilizationRow] = []
+    summary: list[UtilizationRow] = []
+    for row in iter_utilization_rows(anki):
+        (summary if row.detail_level == 'Summary' else ret).append(row)
+    ret.sort(key=lambda x: x.sort_key)
+    ret.extend(sorted(summary, key=lambda x: x.sort_key))
 
     return ret
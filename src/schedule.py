@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+import traceback
+from typing import TYPE_CHECKING, Any, Callable, NewType
+
+try:
+    from typing import Self
+except:
+    # support older versions of python
+    Self = NewType('Self', Any) # type: ignore[misc, valid-newtype, no-redef]
+
+if TYPE_CHECKING:
+    from .anki_api import AnkiApi as Anki
+
+# seconds to wait past the scheduler's day cutoff so `sched.today` has advanced when the update runs
+DAY_ROLLOVER_MARGIN = 5
+# seconds to wait before trying again after an error, such as the collection being closed for a full sync
+ERROR_RETRY_DELAY = 60
+
+
+def next_run_delay(now: float, day_cutoff: float, interval_seconds: float) -> float:
+    '''returns the seconds until the next update should run, which is the sooner of the interval or the next day rollover'''
+    until_rollover = max(0.0, day_cutoff - now) + DAY_ROLLOVER_MARGIN
+    return min(max(60.0, interval_seconds), until_rollover)
+
+class LimitScheduler:
+    '''Runs `update` on a background thread when limits may have changed rather than on a fixed timer.
+
+    The thread wakes at the next day rollover, after `updateLimitsIntervalReviewCount` reviews, once no card has been answered
+    for `updateLimitsIdleTimeInMinutes` after studying, or at the latest every `updateLimitsIntervalTimeInMinutes`. A wake-up
+    where the day and collection are unchanged since the last run is skipped.
+    '''
+
+    def __init__(self: Self, anki: Anki, update: Callable[[], None]) -> None:
+        self._anki = anki
+        self._update = update
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._reviews = 0
+        self._last_review = 0.0
+        self._review_threshold = 0 # read from the config by the thread so answering a card does not read it from disk
+        self._last_state: tuple[int, int] | None = None
+        self._running = False
+
+    def start_if_enabled(self: Self) -> None:
+        '''starts the background thread unless it is already running or `updateLimitsOnInterval` is disabled'''
+        with self._lock:
+            if self._running or not self._anki.get_config().get('updateLimitsOnInterval', False):
+                return
+            self._running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def on_profile_did_open(self: Self) -> None:
+        self._ready.set()
+        self._wake.set()
+
+    def on_profile_will_close(self: Self) -> None:
+        self._ready.clear()
+        self._last_state = None
+
+    def on_review(self: Self) -> None:
+        if not self._running:
+            return
+        with self._lock:
+            self._reviews += 1
+            self._last_review = time.monotonic()
+            if self._review_threshold > 0 and self._reviews >= self._review_threshold:
+                self._wake.set()
+
+    def _state(self: Self) -> tuple[int, int]:
+        col = self._anki.col()
+        return (col.sched.today, col.mod)
+
+    def _loop(self: Self) -> None:
+        try:
+            while True:
+                self._ready.wait() # collection is not accessible until a profile is open
+
+                addon_config = self._anki.get_config()
+                with self._lock:
+                    if not addon_config.get('updateLimitsOnInterval', False):
+                        self._running = False # restarted by `start_if_enabled` should it be enabled again
+                        return
+                    self._review_threshold = addon_config.get('updateLimitsIntervalReviewCount', 0)
+
+                try:
+                    self._run_when_due(addon_config)
+                except Exception:
+                    # the profile can close while waiting or updating, which should not stop future updates
+                    traceback.print_exc()
+                    # only a wake-up while waiting ends the wait early, which is left set so the next pass does not wait again
+                    self._wake.clear()
+                    self._wake.wait(ERROR_RETRY_DELAY)
+        except BaseException:
+            # a thread that stops for any other reason must also let `start_if_enabled` start a new one
+            with self._lock:
+                self._running = False
+            raise
+
+    def _idle_delay(self: Self, idle_seconds: float) -> float:
+        '''returns the seconds until no card has been answered for `idle_seconds` after studying, or `inf` if not studying'''
+        with self._lock:
+            if idle_seconds <= 0 or self._reviews == 0:
+                return math.inf
+            return max(0.0, self._last_review + idle_seconds - time.monotonic())
+
+    def _run_when_due(self: Self, addon_config: dict[str, Any]) -> None:
+        interval_seconds = addon_config['updateLimitsIntervalTimeInMinutes'] * 60
+        idle_seconds = addon_config.get('updateLimitsIdleTimeInMinutes', 0) * 60
+
+        scheduled_delay = next_run_delay(time.time(), self._anki.col().sched.day_cutoff, interval_seconds)
+        idle_delay = self._idle_delay(idle_seconds)
+        woken = self._wake.wait(min(scheduled_delay, idle_delay))
+        self._wake.clear()
+
+        # a card answered while waiting for the idle period pushes it back
+        if not woken and idle_delay < scheduled_delay and self._idle_delay(idle_seconds) > 0:
+            return
+
+        # the pending reviews are handled by this wake-up, whether or not an update is needed
+        with self._lock:
+            self._reviews = 0
+        if not self._ready.is_set() or self._state() == self._last_state:
+            return
+
+        self._update()
+        self._last_state = self._state() # taken after the update so saving the limits does not count as a change
@@ -4,18 +4,41 @@ import os
 import sys
 
 from PyQt6.QtWebEngineWidgets import *
-from PyQt6.QtWidgets import QApplication
+from PyQt6.QtWidgets import QApplication, QMainWindow, QMenu
 
 os.environ["TEST"] = "True"
 app = QApplication(sys.argv)
 
+import contextlib
+import csv
+import io
+import json
+import random
 import re
+import sqlite3
+import subprocess
+import tempfile
+import time
 import unittest
+import unittest.mock
+from collections import Counter
 from types import SimpleNamespace
 from typing import Any, Self
 
+import src
+from src import history, metrics
+from src import limit as limit_module
+from src.export import export_rule_mapping, export_utilization
 from src.limit import update_limits
+from src.metrics import METRICS
 from src.report import limit_utilization_report_data
+from src.schedule import DAY_ROLLOVER_MARGIN, LimitScheduler, next_run_delay
+
+# time spent importing and initializing the add-on when anki loads it, excluding importing anki and qt
+STARTUP_BUDGET_MICROSECONDS = 50_000
+
+# backend calls that are made for a single deck, counted by the mock along with `db` and `save_deck`
+DECK_CALLS = ['get_subdeck_ids', 'get_deck_by_id', 'config_dict_for_deck_id']
 
 def create_mock_limit(deck_names: list[str], young: int | None = None, load: float | None = None, soon: int | None = None, soon_days: int | None = None, minimum: int | None = None, collective: bool = False) -> dict[str, Any]:
     ret = {'deckNames': deck_names}
@@ -36,11 +59,45 @@ def create_mock_limit(deck_names: list[str], young: int | None = None, load: flo
 def create_mock_deck(id: int, name: str, cards: int, young: int, load: float, soon: int, new: int, new_limit: int, max_new: int, deck_max_new: int | None = None) -> dict[str, Any]:
     return {'id': id, 'name': name, 'cards': cards, 'young': young, 'load': load, 'soon': soon, 'newToday': [0, 0] if not new else [0, new], 'newLimitToday': None if not new_limit else {'today': 0, 'limit': new_limit}, 'new': {'perDay': max_new }, 'newLimit': deck_max_new}
 
-def create_mock_anki(limits, decks):
+def create_mock_anki(limits, decks, config=None, history_path=None):
+    by_id = {x['id']: x for x in decks}
+    by_name = {x['name']: x for x in decks}
+
+    # like anki, the metrics of a deck include the cards of all of it's sub decks
+    subdeck_ids = {x['id']: [x['id']] for x in decks}
+    for deck in decks:
+        parts = deck['name'].split('::')
+        for idx in range(1, len(parts)):
+            parent = by_name.get('::'.join(parts[:idx]))
+            if parent:
+                subdeck_ids[parent['id']].append(deck['id'])
+
+    # fixture keys for the columns of each metric, metrics that are only used by a few tests default to 0
+    metric_keys = {'cards': 'cards', 'seen': 'seen', 'youngCardLimit': 'young', 'loadLimit': 'load', 'soonLimit': 'soon', 'difficultyLoadLimit': 'difficulty_load', 'learningLimit': 'learning'}
+
+    def metric_value(deck, column):
+        key = metric_keys[re.sub('[(].*', '', column)]
+        if key == 'seen' and key not in deck:
+            return deck['cards']
+        if key not in deck:
+            return 0
+        if deck[key] is None:
+            raise AssertionError(f'{column} of {deck["name"]} should not need to be calculated')
+        return deck[key]
+
     class MockAnki:
 
+        def __init__(self):
+            # number of calls to the backend, which are the costly part of updating limits
+            self.calls = Counter()
+            # like anki, the collection's modification time changes when a deck is saved or the collection is synced
+            self.mod = 0
+
+        def history_path(self):
+            return history_path
+
         def get_config(self):
-            return {'limits': limits}
+            return {'limits': limits, **(config or {})}
 
         def write_config(self, config):
             pass
@@ -48,40 +105,49 @@ def create_mock_anki(limits, decks):
         def get_deck_identifiers(self):
             return [SimpleNamespace(id=x['id'], name=x['name']) for x in decks]
 
-        def get_subdeck_ids_csv(self, deck_id):
-            return str(deck_id)
+        def get_subdeck_ids(self, deck_id):
+            self.calls['get_subdeck_ids'] += 1
+            return subdeck_ids[deck_id]
 
         def get_deck_by_id(self, deck_id):
-            return next(x for x in decks if x['id'] == deck_id)
+            self.calls['get_deck_by_id'] += 1
+            return by_id[deck_id]
 
         def save_deck(self, deck) -> None:
-            pass
+            self.calls['save_deck'] += 1
+            self.mod += 1
 
         def config_dict_for_deck_id(self, deck_id):
-            return next(x for x in decks if x['id'] == deck_id)
+            self.calls['config_dict_for_deck_id'] += 1
+            return by_id[deck_id]
 
         def col(self):
-            def f(search):
-                deck_id = int(re.sub('.*did:([0-9]*).*', '\\1', search))
-                deck = [x for x in decks if x['id'] == deck_id][0]
-                if 'prop:ivl<21' in search:
-                    return list(range(deck['young']))
-                if 'prop:due<' in search:
-                    return list(range(deck['soon']))
-                return list(range(deck['cards']))
-            return SimpleNamespace(sched =  SimpleNamespace(today= 0), find_cards=f)
+            return SimpleNamespace(sched = SimpleNamespace(today = 0, day_cutoff = 86400), mod = self.mod)
 
         def db(self):
-            def f(search):
-                did = [x for x in search.split('\n') if 'did IN' in x][0]
-                return [decks[0]['load']]
-            return SimpleNamespace(first = f)
+            def first(query):
+                self.calls['db'] += 1
+                return [max(x.get('mod', 0) for x in decks), len(decks)]
+            def all(query):
+                self.calls['db'] += 1
+                searched = [by_id[int(x)] for x in re.search(r'did IN \(([0-9,]+)\)', query).group(1).split(',')]
+                columns = re.findall('AS "([^"]+)"', query)
+                return [[x['id'], 0, *[metric_value(x, column) for column in columns]] for x in searched]
+            return SimpleNamespace(first = first, all = all)
 
         def safe_reset(self):
             pass
 
     return MockAnki()
 
+def create_scale_decks(count: int, fanout: int | None = None) -> list[dict[str, Any]]:
+    '''creates `count` decks as a tree with `fanout` sub decks per deck, or all at the top level if not given'''
+    decks = []
+    for idx in range(count):
+        name = f'deck {idx}' if fanout is None or idx == 0 else f"{decks[(idx - 1) // fanout]['name']}::deck {idx}"
+        decks.append(create_mock_deck(id=idx + 1, name=name, cards=200, young=idx % 40, load=idx % 30 / 2, soon=idx % 20, new=idx % 3, new_limit=None, max_new=10))
+    return decks
+
 class Test(unittest.TestCase):
 
     def test_young_limit(self: Self) -> None:
@@ -115,6 +181,35 @@ class Test(unittest.TestCase):
 
         self.assertEqual(1, deck['newLimitToday']['limit'], 'min(limit - value) = soon_limit - soon = 5 - 4 = 1')
 
+    def test_difficulty_load_limit(self: Self) -> None:
+        deck = create_mock_deck(id=1, name='A', cards=1000, young=0, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        deck['difficulty_load'] = 3.5
+        limit = create_mock_limit(deck_names=['A'])
+        limit['difficultyLoadLimit'] = 6
+        anki = create_mock_anki([limit], [deck])
+
+        update_limits(anki, force_update=True)
+
+        self.assertEqual(3, deck['newLimitToday']['limit'], 'difficulty_load_limit - difficulty_load = ceil(6 - 3.5) = 3')
+
+        # difficult cards count for more than 1, so the load can be over the number of cards
+        deck['cards'] = 4
+        deck['difficulty_load'] = 7
+        update_limits(anki, force_update=True)
+
+        self.assertEqual(0, deck['newLimitToday']['limit'], 'the limit is over the deck size but not over the weighted load')
+
+    def test_learning_limit(self: Self) -> None:
+        deck = create_mock_deck(id=1, name='A', cards=1000, young=0, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        deck['learning'] = 8
+        limit = create_mock_limit(deck_names=['A'], young=50)
+        limit['learningLimit'] = 10
+        anki = create_mock_anki([limit], [deck])
+
+        update_limits(anki, force_update=True)
+
+        self.assertEqual(2, deck['newLimitToday']['limit'], 'learning_limit - learning = 10 - 8 = 2')
+
     def test_deck_has_new(self: Self) -> None:
         deck = create_mock_deck(id=1, name='A', cards=1000, young=3, load=None, soon=None, new=1, new_limit=None, max_new=10)
         limit = create_mock_limit(deck_names=['A'], young=5)
@@ -136,6 +231,28 @@ class Test(unittest.TestCase):
         # reduced to have the effective limit reach the original target.
         self.assertEqual(1, deck['newLimitToday']['limit'], 'young_card_limit - young_count + new = 5 - 3 - 1 = 1')
 
+    def test_metrics_query_includes_filtered_cards(self: Self) -> None:
+        con = sqlite3.connect(':memory:')
+        con.execute('CREATE TABLE cards (did INTEGER, odid INTEGER, queue INTEGER, type INTEGER, ivl INTEGER, due INTEGER, odue INTEGER, data TEXT)')
+        con.executemany('INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            (1, 0, 2, 2, 5, 3, 0, ''), # young review card due soon
+            (9, 1, 2, 2, 5, 100, 3, ''), # the same in filtered deck 9, which uses the original due date
+            (9, 2, 2, 2, 50, 100, 50, ''), # mature card from another deck in filtered deck 9
+            (1, 0, -1, 2, 5, 3, 0, ''), # suspended
+        ])
+        subdeck_ids = {1: [1], 2: [2], 3: [3, 9]} # deck 3 is the parent of filtered deck 9
+        anki = SimpleNamespace(
+            get_subdeck_ids=lambda did: subdeck_ids[did],
+            db=lambda: SimpleNamespace(all=lambda query: con.execute(query).fetchall()))
+        context = {'today': 0, 'day_cutoff': 86400}
+        columns = dict(metrics.column(x, {}, context) for x in METRICS.values())
+
+        data = metrics.query(anki, [1, 2, 3], columns)
+
+        self.assertEqual((2, 2, 2), (data[1]['cards'], data[1]['youngCardLimit'], data[1]['soonLimit(7)']), 'cards in a filtered deck count towards their home deck')
+        self.assertEqual((1, 0), (data[2]['cards'], data[2]['youngCardLimit']), 'mature card from deck 2')
+        self.assertEqual(2, data[3]['cards'], 'like `deck:`, cards in a filtered sub deck also count towards the parent')
+
     def test_report_summary(self: Self) -> None:
         deck = create_mock_deck(id=1, name='A', cards=1000, young=3, load=10.2, soon=4, new=0, new_limit=None, max_new=10)
         limit = create_mock_limit(deck_names=['A'], young=5, load=15.1, soon=5)
@@ -152,6 +269,38 @@ class Test(unittest.TestCase):
         summary = [x for x in data if x.detail_level == 'Summary'][0]
         self.assertEqual('youngCardLimit', summary.limit_type, 'should not pick an undefined limit type, even if the value is higher')
 
+    def test_export_utilization(self: Self) -> None:
+        deck_a = create_mock_deck(id=1, name='A', cards=1000, young=3, load=10.2, soon=4, new=0, new_limit=None, max_new=10)
+        deck_b = create_mock_deck(id=2, name='B', cards=1000, young=3, load=10.2, soon=4, new=0, new_limit=None, max_new=10)
+        limit = create_mock_limit(deck_names=['A'], young=5)
+        anki = create_mock_anki([limit], [deck_a, deck_b])
+
+        with tempfile.TemporaryDirectory() as d:
+            self.assertEqual(2 * (len(METRICS) + 1), export_utilization(anki, f'{d}/a.csv'), 'each limit type and 1 summary per deck')
+            with open(f'{d}/a.csv') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual('youngCardLimit', rows[0]['limit_type'])
+            self.assertEqual('5', rows[0]['limit'])
+            self.assertEqual('', rows[1]['limit'], 'undefined limits are empty rather than inf')
+
+            self.assertEqual(2 * (len(METRICS) + 1), export_utilization(anki, f'{d}/a.jsonl'))
+            with open(f'{d}/a.jsonl') as f:
+                rows = [json.loads(x) for x in f]
+            self.assertEqual('Summary', rows[len(METRICS)]['detail_level'])
+            self.assertEqual(60.0, rows[len(METRICS)]['utilization'])
+            self.assertIsNone(rows[1]['limit'])
+
+    def test_export_rule_mapping(self: Self) -> None:
+        decks = [create_mock_deck(id=x, name=n, cards=0, young=0, load=0, soon=0, new=0, new_limit=None, max_new=10) for x, n in enumerate('ABC')]
+        limits = [create_mock_limit(deck_names=['A'], young=5), create_mock_limit(deck_names=['A', 'B'], young=5)]
+        anki = create_mock_anki(limits, decks)
+
+        with tempfile.TemporaryDirectory() as d:
+            export_rule_mapping(anki, f'{d}/a.jsonl')
+            with open(f'{d}/a.jsonl') as f:
+                rows = [(x['rule'], x['relation'], x['applied_rule'], x['deck_name']) for x in map(json.loads, f)]
+        self.assertEqual([(1, 'applies', 1, 'A'), (2, 'applies', 2, 'B'), (2, 'matches', 1, 'A'), (None, 'none', None, 'C')], rows)
+
     def test_minimum_limit(self: Self) -> None:
         deck = create_mock_deck(id=1, name='A', cards=1000, young=5, load=10.2, soon=0, new=0, new_limit=None, max_new=10)
         limit = create_mock_limit(deck_names=['A'], young=6, minimum=2)
@@ -255,6 +404,248 @@ class Test(unittest.TestCase):
 
         self.assertEqual(2, deck['newLimitToday']['limit'], 'single deck: 5 - 3 = 2, same as old behavior')
 
+    def test_unchanged_rule_group_is_skipped(self: Self) -> None:
+        limit_module._group_fingerprints.clear()
+        deck = create_mock_deck(id=1, name='A', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        limit = create_mock_limit(deck_names=['A'], young=5)
+        anki = create_mock_anki([limit], [deck], {'recalculateLimitIfAlreadySet': True})
+
+        update_limits(anki)
+        self.assertEqual(2, deck['newLimitToday']['limit'], '5 - 3 = 2')
+
+        deck['young'] = 4
+        update_limits(anki)
+        self.assertEqual(2, deck['newLimitToday']['limit'], 'cards are unchanged so the group should be skipped')
+
+        deck['mod'] = 1
+        update_limits(anki)
+        self.assertEqual(1, deck['newLimitToday']['limit'], 'cards have changed so the group should be recalculated')
+
+        deck['young'] = 3
+        update_limits(anki, force_update=True)
+        self.assertEqual(2, deck['newLimitToday']['limit'], 'forced updates ignore the fingerprint')
+
+        deck['young'] = 4
+        anki.mod += 1
+        update_limits(anki)
+        self.assertEqual(1, deck['newLimitToday']['limit'], 'synced cards keep their `mod` but the collection has changed')
+
+    def test_renamed_collective_deck_is_recalculated(self: Self) -> None:
+        limit_module._group_fingerprints.clear()
+        deck_a = create_mock_deck(id=1, name='A', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        deck_b = create_mock_deck(id=2, name='B', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        limit = create_mock_limit(deck_names='.*', young=10, collective=True)
+        anki = create_mock_anki([limit], [deck_a, deck_b], {'recalculateLimitIfAlreadySet': True})
+
+        update_limits(anki)
+        self.assertEqual((4, 0), (deck_a['newLimitToday']['limit'], deck_b['newLimitToday']['limit']), '10 - 6 = 4 given to A first')
+
+        deck_a['name'] = 'C'
+        update_limits(anki)
+        self.assertEqual((0, 4), (deck_a['newLimitToday']['limit'], deck_b['newLimitToday']['limit']), 'B is now first by name')
+
+    def test_metrics_pruned_when_limit_is_determined(self: Self) -> None:
+        # metrics of `None` raise if queried
+        no_new = create_mock_deck(id=1, name='A', cards=None, young=None, load=None, soon=None, new=None, new_limit=None, max_new=0)
+        minimum = create_mock_deck(id=2, name='B', cards=None, young=None, load=None, soon=None, new=None, new_limit=None, max_new=3)
+        young_only = create_mock_deck(id=3, name='C', cards=1000, young=20, load=0, soon=None, new=None, new_limit=None, max_new=10)
+        limits = [create_mock_limit(deck_names=['A', 'B'], young=5, soon=5, minimum=3), create_mock_limit(deck_names=['C'], young=5, load=20)]
+        anki = create_mock_anki(limits, [no_new, minimum, young_only])
+
+        update_limits(anki, force_update=True)
+
+        self.assertEqual(3, no_new['newLimitToday']['limit'], 'native limit of 0 only leaves the minimum')
+        self.assertEqual(3, minimum['newLimitToday']['limit'], 'native limit equal to the minimum')
+        self.assertEqual(0, young_only['newLimitToday']['limit'], 'over the young limit')
+
+    def test_young_cards_not_seen(self: Self) -> None:
+        # buried cards in learning are young but not `is:learn OR is:review`, so young can be over the seen cards
+        deck = create_mock_deck(id=1, name='A', cards=5, young=5, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        deck['seen'] = 0
+        limit = create_mock_limit(deck_names=['A'], young=5)
+        anki = create_mock_anki([limit], [deck])
+
+        update_limits(anki, force_update=True)
+
+        self.assertEqual(0, deck['newLimitToday']['limit'], '5 - 5 = 0, the seen cards are not a bound on young cards')
+
+    def test_history_recorded(self: Self) -> None:
+        deck_a = create_mock_deck(id=1, name='A', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=0)
+        deck_b = create_mock_deck(id=2, name='B', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        limit = create_mock_limit(deck_names=['A', 'B'], young=5)
+
+        with tempfile.TemporaryDirectory() as d:
+            anki = create_mock_anki([limit], [deck_a, deck_b], {'recordHistory': True}, f'{d}/history.db')
+            update_limits(anki, force_update=True)
+            samples = history.read(f'{d}/history.db')
+
+        self.assertEqual([(1, {}, 0), (2, {'youngCardLimit': 3}, 2)], [(x.deck_id, x.metrics, x.new_limit) for x in samples], 'young is not queried for A as it has no new cards')
+
+    def test_history_error_is_not_fatal(self: Self) -> None:
+        deck = create_mock_deck(id=1, name='A', cards=1000, young=3, load=None, soon=None, new=0, new_limit=None, max_new=10)
+        limit = create_mock_limit(deck_names=['A'], young=5)
+
+        with tempfile.TemporaryDirectory() as d, contextlib.redirect_stderr(io.StringIO()) as stderr:
+            anki = create_mock_anki([limit], [deck], {'recordHistory': True}, d) # a directory can not be opened as a database
+            update_limits(anki, force_update=True)
+
+        self.assertEqual(2, deck['newLimitToday']['limit'], 'limits are saved even if the history is not')
+        self.assertIn('sqlite3', stderr.getvalue(), 'errors are reported')
+
+    def test_history_retention(self: Self) -> None:
+        def sample(day: int, deck_id: int, new_limit: int) -> history.Sample:
+            return history.Sample(0, day, deck_id, {}, False, new_limit)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = f'{d}/history.db'
+            history.append(path, 0, [sample(0, 1, 5), sample(0, 1, 4), sample(0, 2, 3)])
+            history.append(path, 1, [sample(1, 1, 2)])
+            self.assertEqual(4, len(history.read(path)), 'recent samples are kept')
+            history.append(path, 1, [sample(1, 1, 2), sample(1, 2, 3)])
+            self.assertEqual(4, len(history.read(path)), 'samples that are unchanged since the last one for the deck are skipped')
+
+            history.append(path, 1 + history.FULL_RESOLUTION_DAYS, [sample(1 + history.FULL_RESOLUTION_DAYS, 1, 1)])
+            self.assertEqual([(0, 1, 4), (0, 2, 3), (1, 1, 2), (8, 1, 1)], [(x.day, x.deck_id, x.new_limit) for x in history.read(path)], 'old samples are reduced to the last of each day per deck')
+            self.assertEqual([2, 1], [x.new_limit for x in history.read(path, since_day=1, deck_id=1)])
+
+            history.append(path, 9, [sample(9, 3, x) for x in range(10)], max_rows=5)
+            self.assertEqual([5, 6, 7, 8, 9], [x.new_limit for x in history.read(path)], 'oldest samples are removed over the size cap')
+
+    def test_history_retention_with_frequent_updates(self: Self) -> None:
+        # 200 decks updated 40 times a day for 2 weeks, where each update changes the values of a few decks
+        deck_count, runs_per_day, days = 200, 40, 14
+        rnd = random.Random(0)
+        young = [rnd.randrange(50) for _ in range(deck_count)]
+
+        with tempfile.TemporaryDirectory() as d:
+            path = f'{d}/history.db'
+            for day in range(days):
+                for _ in range(runs_per_day):
+                    for did in rnd.sample(range(deck_count), 10):
+                        young[did] = rnd.randrange(50)
+                    history.append(path, day, [history.Sample(0, day, did, {'youngCardLimit': young[did]}, False, 50 - young[did]) for did in range(deck_count)])
+            samples = history.read(path)
+
+        self.assertEqual(0, samples[0].day, 'the first day is still kept')
+        old = Counter((x.deck_id, x.day) for x in samples if x.day < days - 1 - history.FULL_RESOLUTION_DAYS)
+        self.assertEqual(1, max(old.values()), 'old samples are reduced to one per deck per day')
+        self.assertLess(len(samples), history.MAX_ROWS)
+
+    # === Query budget tests (backend calls should grow with the number of decks, not decks x rules) ===
+
+    def test_update_limits_query_budget(self: Self) -> None:
+        for fanout in [None, 4]:
+            for collective in [False, True]:
+                with self.subTest(fanout=fanout, collective=collective):
+                    limit_module._group_fingerprints.clear()
+                    decks = create_scale_decks(2000, fanout)
+                    limits = [create_mock_limit(deck_names=['deck 0'], young=30), create_mock_limit(deck_names='.*', young=30, load=10, soon=15, minimum=1, collective=collective), create_mock_limit(deck_names='.*', young=1)]
+                    anki = create_mock_anki(limits, decks, {'recalculateLimitIfAlreadySet': True})
+
+                    update_limits(anki)
+                    self.assertLessEqual(anki.calls['db'], 2, 'the fingerprint stamp and a single pass over the cards')
+                    self.assertLessEqual(anki.calls['save_deck'], len(decks), 'each deck is saved at most once')
+                    for call in DECK_CALLS:
+                        self.assertLessEqual(anki.calls[call], 3 * len(decks), f'{call} for the fingerprint before and after, and for the limit')
+
+                    anki.calls.clear()
+                    update_limits(anki)
+                    self.assertEqual(1, anki.calls['db'], 'only the fingerprint stamp when nothing changed')
+                    self.assertEqual(0, anki.calls['save_deck'], 'nothing changed so nothing is saved')
+                    for call in DECK_CALLS:
+                        self.assertLessEqual(anki.calls[call], len(decks), f'{call} only for the fingerprint when nothing changed')
+
+    def test_report_query_budget(self: Self) -> None:
+        for fanout in [None, 4]:
+            for collective in [False, True]:
+                with self.subTest(fanout=fanout, collective=collective):
+                    decks = create_scale_decks(2000, fanout)
+                    limits = [create_mock_limit(deck_names='.*', young=30, load=10, soon=15, collective=collective), create_mock_limit(deck_names='.*', young=1)]
+                    anki = create_mock_anki(limits, decks)
+
+                    data = limit_utilization_report_data(anki)
+                    self.assertEqual((len(METRICS) + 1) * len(decks), len(data), 'each limit type and 1 summary per deck')
+                    self.assertEqual(1, anki.calls['db'], 'a single pass over the cards')
+                    self.assertEqual(0, anki.calls['save_deck'], 'reports do not modify decks')
+                    for call in DECK_CALLS:
+                        self.assertLessEqual(anki.calls[call], len(decks), f'{call} at most once per deck')
+
+    def test_next_run_delay(self: Self) -> None:
+        self.assertEqual(900, next_run_delay(now=0, day_cutoff=86400, interval_seconds=900), 'interval is sooner than the day rollover')
+        self.assertEqual(300 + DAY_ROLLOVER_MARGIN, next_run_delay(now=86100, day_cutoff=86400, interval_seconds=900), 'day rollover is sooner than the interval')
+        self.assertEqual(60, next_run_delay(now=0, day_cutoff=86400, interval_seconds=0), 'interval is at least a minute')
+
+    def test_scheduler(self: Self) -> None:
+        config = {'updateLimitsOnInterval': True, 'updateLimitsIntervalTimeInMinutes': 15, 'updateLimitsIntervalReviewCount': 2}
+        anki = create_mock_anki([], [], config)
+        updates = []
+        def update() -> None:
+            updates.append(anki.mod)
+            if len(updates) == 1:
+                raise RuntimeError('collection was closed')
+
+        def wait_for_updates(count: int) -> None:
+            deadline = time.monotonic() + 5
+            while len(updates) < count and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        scheduler = LimitScheduler(anki, update)
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            scheduler.start_if_enabled()
+            scheduler.on_profile_did_open()
+            wait_for_updates(1)
+
+            anki.mod += 1
+            scheduler.on_review()
+            scheduler.on_review()
+            wait_for_updates(2)
+        self.assertEqual([0, 1], updates, 'the thread keeps running after an update fails and wakes after the review count')
+        self.assertIn('collection was closed', stderr.getvalue(), 'errors are reported')
+
+        config['updateLimitsOnInterval'] = False
+        scheduler.on_profile_did_open()
+
+    def test_scheduler_waits_after_error(self: Self) -> None:
+        config = {'updateLimitsOnInterval': True, 'updateLimitsIntervalTimeInMinutes': 15}
+        anki = create_mock_anki([], [], config)
+        def col() -> None:
+            anki.calls['col'] += 1
+            raise RuntimeError('collection is closed for a full sync')
+        anki.col = col
+
+        scheduler = LimitScheduler(anki, lambda: None)
+        with unittest.mock.patch('src.schedule.ERROR_RETRY_DELAY', 0.1), contextlib.redirect_stderr(io.StringIO()):
+            scheduler.start_if_enabled()
+            scheduler.on_profile_did_open()
+            time.sleep(0.5)
+            config['updateLimitsOnInterval'] = False
+            scheduler.on_profile_did_open()
+
+        self.assertLessEqual(anki.calls['col'], 10, 'each error waits before trying again rather than retrying in a loop')
+
+    def test_startup_cost(self: Self) -> None:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import src'], cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, 'TEST': 'True'}, capture_output=True, text=True, check=True)
+        # lines are formatted as `import time: self [us] | cumulative | imported package`
+        self_times = {m.group(2).strip(): int(m.group(1)) for m in re.finditer(r'import time:\s*(\d+) \|\s*\d+ \|(.*)', result.stderr)}
+        loaded = [x for x in self_times if x.strip() == 'src' or x.strip().startswith('src.')]
+
+        for module in ['src.limit', 'src.report', 'src.export']:
+            self.assertNotIn(module, loaded, f'{module} should be imported when first used rather than on load')
+        import_microseconds = sum(self_times[x] for x in loaded)
+
+        # `init` adds the hooks and menu to anki's main window, using the default config
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'config.json')) as f:
+            default_config = json.load(f)
+        class MainWindow(QMainWindow):
+            addonManager = SimpleNamespace(getConfig=lambda name: default_config, setConfigUpdatedAction=lambda name, action: None)
+            form = SimpleNamespace(menuTools=QMenu())
+        with unittest.mock.patch('aqt.mw', MainWindow()):
+            start = time.perf_counter()
+            src.init()
+            init_microseconds = (time.perf_counter() - start) * 1_000_000
+
+        self.assertLess(import_microseconds + init_microseconds, STARTUP_BUDGET_MICROSECONDS, f'import time of {loaded} ({import_microseconds}us) and init ({init_microseconds:.0f}us) is over budget')
+
 
 if __name__ == '__main__':
     unittest.main()